@@ -50,6 +50,13 @@ secrets:
 
 awsRegion: "your-cluster-region"
 
+# Wait for newly registered targets to pass health checks before finishing a run
+waitForInService: false
+
+# Only scan target groups tagged castai:cluster-id=<cluster ID> for registrations to remove;
+# target groups from node configurations are registered whether tagged or not
+filterTargetGroupsByTag: false
+
 nodeSelector: {}
   # example:
   # role: worker
@@ -198,6 +205,10 @@ spec:
               key: clusterId
         - name: AWS_REGION
           value: {{ .Values.awsRegion }}
+        - name: WAIT_FOR_IN_SERVICE
+          value: {{ .Values.waitForInService | quote }}
+        - name: FILTER_TARGET_GROUPS_BY_TAG
+          value: {{ .Values.filterTargetGroupsByTag | quote }}
 EOL
 }
 
@@ -1,11 +1,64 @@
 import os
 import logging
+import orjson
 import requests
 import boto3
 import time
+from collections import defaultdict
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-# Configuring logging with a reusable setup
+# Shared HTTP session so Cast AI API calls reuse pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+))
+SESSION.headers.update({'accept': 'application/json'})
+
+# Upper bound on concurrent Cast AI API requests (kept below the pool size above)
+HTTP_CONCURRENCY = 16
+
+# Upper bound on concurrent ELBv2 calls
+AWS_CONCURRENCY = 10
+
+# Node labels set by the CAST.AI provisioner
+MANAGED_BY = 'provisioner.cast.ai/managed-by'
+CFG_ID = 'provisioner.cast.ai/node-configuration-id'
+
+# One ELBv2 client per region for the lifetime of the process
+_ELB_CLIENTS = {}
+
+# Tag that marks a target group as belonging to a cluster when tag filtering is enabled
+CLUSTER_ID_TAG = 'castai:cluster-id'
+
+# Tagged target group ARNs per (region, cluster ID) as (expiry, ARNs); tags change rarely,
+# so the lookup is reused across runs for TAGGED_TG_TTL seconds
+_TAGGED_TG_CACHE = {}
+TAGGED_TG_TTL = 600
+
+# Bounds for the optional target_in_service waiter run after registration
+IN_SERVICE_WAITER_CONFIG = {'Delay': 5, 'MaxAttempts': 12}
+
+# Get the shared ELBv2 client for a region, creating it on first use
+def _elb(region):
+    if region not in _ELB_CLIENTS:
+        _ELB_CLIENTS[region] = boto3.Session().client(
+            'elbv2',
+            region_name=region,
+            config=Config(retries={'mode': 'adaptive', 'max_attempts': 5}, max_pool_connections=32)
+        )
+    return _ELB_CLIENTS[region]
+
+# Configuring logging with a reusable setup; repeated calls reuse the existing configuration
 def configure_logging():
+    if logging.getLogger().handlers:
+        return logging.getLogger(__name__)
+
     log_level = os.getenv('LOG_LEVEL', 'INFO').upper()
     logging.basicConfig(
         level=log_level,
@@ -14,148 +67,428 @@ def configure_logging():
     logger = logging.getLogger(__name__)
     logger.info("\n" + "=" * 40)
     logger.info(">>> APPLICATION STARTUP")
-    logger.info(f">>> Logging Level: {log_level}")
+    logger.info(">>> Logging Level: %s", log_level)
     logger.info("=" * 40 + "\n")
     return logger
 
-# Generic function to fetch data from API
+# Generic function to fetch data from API; returns (ok, data) so callers can branch
+# on failures without exception handling
 def fetch_data(url, headers, params=None, logger=None):
     try:
-        logger.info(f"Sending request to {url} with params: {params}")
-        response = requests.get(url, headers=headers, params=params)
+        logger.info("Sending request to %s with params: %s", url, params)
+        response = SESSION.get(url, headers=headers, params=params, timeout=(3.05, 30))
         response.raise_for_status()  # Raise an exception for HTTP errors
-        data = response.json()
-        logger.info(f"[SUCCESS] API Request completed successfully")
-        return data
-    except requests.exceptions.RequestException as e:
-        logger.error(f"[ERROR] API Request failed: {e}")
-        raise  # Re-raise the exception to propagate it to the caller
-
-# Fetching cluster nodes
+        data = orjson.loads(response.content)
+        logger.info("[SUCCESS] API Request completed successfully")
+        return True, data
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+        logger.error("[ERROR] API Request failed: %s", e)
+        return False, None
+
+# Fetching cluster nodes; returns None if the request failed
 def get_cluster_nodes(api_key, cluster_id, logger):
     logger.info("Fetching cluster nodes...")
     url = f'https://api.cast.ai/v1/kubernetes/external-clusters/{cluster_id}/nodes'
     params = {'nodeStatus': 'node_status_unspecified', 'lifecycleType': 'lifecycle_type_unspecified'}
     headers = {'X-API-Key': api_key, 'accept': 'application/json'}
     
-    data = fetch_data(url, headers, params, logger)
+    ok, data = fetch_data(url, headers, params, logger)
+    if not ok:
+        return None
     if data and 'items' in data:
-        logger.info(f"[SUCCESS] Retrieved {len(data['items'])} nodes")
+        logger.info("[SUCCESS] Retrieved %s nodes", len(data['items']))
         return data['items']
     else:
         logger.warning("[WARNING] No nodes found")
         return []
 
-# Fetch target groups for a node configuration
+# Yield (id, instance_id, name, config_id) for every ready, CAST.AI managed node
+def _managed(nodes):
+    for node in nodes:
+        labels = node.get('labels') or {}
+        if labels.get(MANAGED_BY) != 'cast.ai':
+            continue
+        state = node.get('state') or {}
+        if state.get('phase') != 'ready':
+            continue
+        yield node['id'], node['instanceId'], node['name'], labels.get(CFG_ID)
+
+# Fetch target groups for a node configuration as a target group ARN -> port dict;
+# returns None if the request failed
 def get_target_groups_for_node(api_key, cluster_id, node_config_id, logger):
-    logger.info(f"Fetching target groups for node config: {node_config_id}")
+    logger.info("Fetching target groups for node config: %s", node_config_id)
     url = f"https://api.cast.ai/v1/kubernetes/clusters/{cluster_id}/node-configurations/{node_config_id}"
     headers = {'X-API-Key': api_key, 'accept': 'application/json'}
     
-    data = fetch_data(url, headers, logger=logger)
+    ok, data = fetch_data(url, headers, logger=logger)
+    if not ok:
+        return None
     if not data:
         logger.warning("[WARNING] No target groups found")
-        return []
+        return {}
     
-    target_groups = data.get('eks', {}).get('targetGroups', [])
-    logger.info(f"Found {len(target_groups)} target groups")
+    # Tolerate null sections, but treat any other unexpected shape as a failed lookup
+    eks = (data.get('eks') or {}) if isinstance(data, dict) else None
+    target_groups = (eks.get('targetGroups') or []) if isinstance(eks, dict) else None
+    if not isinstance(target_groups, list):
+        logger.error("[ERROR] Unexpected node configuration payload for %s", node_config_id)
+        return None
+    logger.info("Found %s target groups", len(target_groups))
     
-    return [{'arn': tg['arn'], 'port': tg['port']} for tg in target_groups if tg.get('arn') and tg.get('port')]
+    return {
+        tg['arn']: tg['port'] for tg in target_groups
+        if isinstance(tg, dict) and tg.get('arn') and tg.get('port')
+    }
+
+# List every target group in the account as returned by describe_target_groups
+def list_target_groups(elb_client):
+    tg_descriptions = []
+    kwargs = {'PageSize': 400}  # Maximum page size allowed by ELBv2
+    while True:
+        response = elb_client.describe_target_groups(**kwargs)
+        tg_descriptions.extend(response['TargetGroups'])
+        marker = response.get('NextMarker')
+        if not marker:
+            break
+        kwargs['Marker'] = marker
+    return tg_descriptions
+
+# List the target groups tagged with CLUSTER_ID_TAG=cluster_id, reusing the previous
+# result for the same region and cluster until it expires
+def list_cluster_target_groups(elb_client, aws_region, cluster_id):
+    cache_key = (aws_region, cluster_id)
+    cached = _TAGGED_TG_CACHE.get(cache_key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    tg_descriptions = list_target_groups(elb_client)
+    by_arn = {tg['TargetGroupArn']: tg for tg in tg_descriptions}
+    tg_arns = list(by_arn)
+    tagged = []
+    for i in range(0, len(tg_arns), 20):  # describe_tags accepts at most 20 resources per call
+        response = elb_client.describe_tags(ResourceArns=tg_arns[i:i + 20])
+        for description in response['TagDescriptions']:
+            if any(tag['Key'] == CLUSTER_ID_TAG and tag['Value'] == cluster_id for tag in description.get('Tags', [])):
+                tagged.append(by_arn[description['ResourceArn']])
+
+    _TAGGED_TG_CACHE[cache_key] = (time.monotonic() + TAGGED_TG_TTL, tagged)
+    return tagged
+
+# Whether an ELBv2 error is an InvalidTarget rejection
+def _is_invalid_target(error):
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') == 'InvalidTarget'
+
+# Return the IDs among `targets` that are registered to a target group
+def _registered_targets(elb_client, tg_arn, targets):
+    response = elb_client.describe_target_health(TargetGroupArn=tg_arn, Targets=targets)
+    return [
+        target['Target']['Id'] for target in response['TargetHealthDescriptions']
+        # Explicitly requested targets are echoed back even when they are not registered
+        if target.get('TargetHealth', {}).get('Reason') != 'Target.NotRegistered'
+    ]
+
+# Return the IDs among `instance_ids` registered to a target group on any port. Unlike
+# _registered_targets this lists every target of the group, since asking for a target by
+# ID alone only matches its registration on the group's default port
+def _registered_instances(elb_client, tg_arn, instance_ids):
+    response = elb_client.describe_target_health(TargetGroupArn=tg_arn)
+    instance_ids = set(instance_ids)
+    return list(dict.fromkeys(
+        target['Target']['Id'] for target in response['TargetHealthDescriptions']
+        if target['Target']['Id'] in instance_ids and target.get('TargetHealth', {}).get('Reason') != 'Target.NotRegistered'
+    ))
+
+# Whether a target group accepts an instance as a target. Returns (accepted, error), where
+# error is set when the query failed for another reason than InvalidTarget
+def _accepts_instance(elb_client, tg_arn, instance_id):
+    try:
+        _registered_targets(elb_client, tg_arn, [{'Id': instance_id}])
+        return True, None
+    except Exception as e:
+        if _is_invalid_target(e):
+            return False, None
+        return False, e
+
+# Find which instances are valid targets, probing each of them once against one of the
+# rejected target groups. Until an instance is accepted the VPC of the cluster is unknown,
+# so a group from every VPC is tried; after that only the VPC that accepted it is probed.
+# Instances whose probe failed are kept. Returns (valid instance IDs, our VPCs, errors)
+def _valid_instances(elb_client, executor, rejected, instance_ids, our_vpcs):
+    probes = {}
+    for tg in rejected:
+        probes.setdefault(tg.get('VpcId'), tg['TargetGroupArn'])
+    our_vpcs = set(our_vpcs)
+    valid, errors, pending = [], [], list(instance_ids)
+
+    def candidates():
+        return [vpc for vpc in probes if vpc in our_vpcs] or list(probes)
+
+    while pending and len(candidates()) > 1:
+        instance_id = pending.pop(0)
+        for vpc in candidates():
+            accepted, error = _accepts_instance(elb_client, probes[vpc], instance_id)
+            if error is not None:
+                errors.append((probes[vpc], error))
+            if accepted or error is not None:
+                valid.append(instance_id)
+                if accepted and vpc:
+                    our_vpcs.add(vpc)
+                break
+
+    if pending:
+        tg_arn = probes[candidates()[0]]
+        futures = [(instance_id, executor.submit(_accepts_instance, elb_client, tg_arn, instance_id)) for instance_id in pending]
+        for instance_id, future in futures:
+            accepted, error = future.result()
+            if error is not None:
+                errors.append((tg_arn, error))
+            if accepted or error is not None:
+                valid.append(instance_id)
+    return valid, our_vpcs, errors
+
+# Describe target groups once and index them by target, mapping each of the given
+# instance IDs to the set of target group ARNs it is registered to. Every target group
+# in the account is scanned unless tg_descriptions (describe_target_groups entries)
+# narrows the set. Groups in desired_arns are listed in full so that registrations on a
+# port other than the group's default are seen too
+def build_registration_index(elb_client, instance_ids, tg_descriptions=None, desired_arns=()):
+    if tg_descriptions is None:
+        tg_descriptions = list_target_groups(elb_client)
+    # ip, lambda and alb target groups can never hold our instances, and describing them
+    # with instance IDs fails with errors that would otherwise be reported on every run
+    tg_descriptions = [tg for tg in tg_descriptions if tg.get('TargetType', 'instance') == 'instance']
+
+    # Only ask about our own instances rather than transferring every registered target
+    targets = [{'Id': instance_id} for instance_id in instance_ids]
+
+    # describe_target_health calls are independent, so issue them concurrently
+    with ThreadPoolExecutor(max_workers=AWS_CONCURRENCY) as executor:
+        futures = [
+            (tg, executor.submit(_registered_instances, elb_client, tg['TargetGroupArn'], instance_ids))
+            if tg['TargetGroupArn'] in desired_arns else
+            (tg, executor.submit(_registered_targets, elb_client, tg['TargetGroupArn'], targets))
+            for tg in tg_descriptions
+        ]
+
+        registry, errors, rejected, our_vpcs = defaultdict(set), [], [], set()
+        for tg, future in futures:
+            tg_arn = tg['TargetGroupArn']
+            try:
+                registered = future.result()
+            except Exception as e:
+                if _is_invalid_target(e):
+                    rejected.append(tg)
+                else:
+                    errors.append((tg_arn, e))
+                continue
+            # Every instance was accepted as a target, so they live in this group's VPC
+            if tg.get('VpcId'):
+                our_vpcs.add(tg['VpcId'])
+            for instance_id in registered:
+                registry[instance_id].add(tg_arn)
+
+        # A rejected batch either means the group can never hold our instances, or that some
+        # instance is invalid (e.g. already terminated). Find the invalid instances once, then
+        # re-query every group that may hold ours in one call with the valid instances only
+        def outside_our_vpcs(tg):
+            return bool(tg.get('VpcId') and our_vpcs and tg['VpcId'] not in our_vpcs)
+
+        rejected = [tg for tg in rejected if not outside_our_vpcs(tg)]
+        if rejected:
+            valid, our_vpcs, probe_errors = _valid_instances(elb_client, executor, rejected, instance_ids, our_vpcs)
+            errors.extend(probe_errors)
+            valid_targets = [{'Id': instance_id} for instance_id in valid]
+            retries = [
+                (tg, executor.submit(_registered_targets, elb_client, tg['TargetGroupArn'], valid_targets))
+                for tg in rejected if valid and not outside_our_vpcs(tg)
+            ]
+            for tg, future in retries:
+                try:
+                    registered = future.result()
+                except Exception as e:
+                    # A group of unknown VPC rejecting valid instances cannot hold them
+                    if not _is_invalid_target(e) or tg.get('VpcId') in our_vpcs:
+                        errors.append((tg['TargetGroupArn'], e))
+                    continue
+                for instance_id in registered:
+                    registry[instance_id].add(tg['TargetGroupArn'])
+    return registry, errors
 
 # Register instance to target groups
 
 
-def register_instance_to_target_groups(aws_region, instance_id, target_groups, logger):
-    logger.info(f"Registering instance {instance_id} to target groups in {aws_region}")
+# `discovery` is the result of build_registration_index; callers handling several
+# instances pass it in so the account is only scanned once per run
+def register_instance_to_target_groups(aws_region, instance_id, target_groups, logger, discovery=None):
+    logger.info("Registering instance %s to target groups in %s", instance_id, aws_region)
     
-    elb_client = boto3.client('elbv2', region_name=aws_region)
+    elb_client = _elb(aws_region)
     results = {'registered': [], 'already_registered': [], 'deregistered': [], 'failed': []}
+
+    def discover():
+        if discovery is not None:
+            registry, errors = discovery
+        else:
+            registry, errors = build_registration_index(elb_client, [instance_id], desired_arns=set(target_groups or ()))
+        return registry.get(instance_id, set()), errors
     
-    # Check if target_groups is an empty list
+    # Check if target_groups is empty
     if not target_groups:
         logger.info("target_groups is empty, deregistering instance from all existing target groups")
         try:
             # Discover existing registrations
-            paginator = elb_client.get_paginator('describe_target_groups')
-            for page in paginator.paginate():
-                for tg in page['TargetGroups']:
-                    tg_arn = tg['TargetGroupArn']
-                    try:
-                        response = elb_client.describe_target_health(TargetGroupArn=tg_arn)
-                        if any(target['Target']['Id'] == instance_id for target in response['TargetHealthDescriptions']):
-                            # elb_client.deregister_targets(TargetGroupArn=tg_arn, Targets=[{'Id': instance_id}])
-                            results['deregistered'].append(tg_arn)
-                            logger.info(f"Successfully deregistered from {tg_arn} (contact support if not)")
-                    except Exception as e:
-                        logger.error(f"Error deregistering from target group {tg_arn}: {e}")
-                        results['failed'].append({'arn': tg_arn, 'operation': 'deregister', 'error': str(e)})
+            already_set, errors = discover()
+            for tg_arn in sorted(already_set):
+                # elb_client.deregister_targets(TargetGroupArn=tg_arn, Targets=[{'Id': instance_id}])
+                results['deregistered'].append(tg_arn)
+                logger.info("Successfully deregistered from %s (contact support if not)", tg_arn)
+            for tg_arn, e in errors:
+                logger.error("Error deregistering from target group %s: %s", tg_arn, e)
+                results['failed'].append({'arn': tg_arn, 'operation': 'deregister', 'error': str(e)})
         except Exception as e:
-            logger.error(f"Error fetching target groups: {e}")
+            logger.error("Error fetching target groups: %s", e)
             results['failed'].append({'operation': 'deregister', 'error': str(e)})
         return results
     
     # Discover existing registrations
     logger.info("Discovering current registrations...")
     try:
-        paginator = elb_client.get_paginator('describe_target_groups')
-        for page in paginator.paginate():
-            for tg in page['TargetGroups']:
-                tg_arn = tg['TargetGroupArn']
-                try:
-                    response = elb_client.describe_target_health(TargetGroupArn=tg_arn)
-                    if any(target['Target']['Id'] == instance_id for target in response['TargetHealthDescriptions']):
-                        results['already_registered'].append(tg_arn)
-                        logger.info(f"Already registered to {tg_arn}")
-                except Exception as e:
-                    logger.error(f"Error checking target group {tg_arn}: {e}")
-                    results['failed'].append({'arn': tg_arn, 'operation': 'describe_health', 'error': str(e)})
-                    continue
+        already_set, errors = discover()
     except Exception as e:
-        logger.error(f"Error fetching target groups: {e}")
+        logger.error("Error fetching target groups: %s", e)
         results['failed'].append({'operation': 'describe_target_groups', 'error': str(e)})
         return results
+
+    # Membership checks use the set; the list is kept for the results contract
+    results['already_registered'] = sorted(already_set)
+    for tg_arn in results['already_registered']:
+        logger.info("Already registered to %s", tg_arn)
+    for tg_arn, e in errors:
+        logger.error("Error checking target group %s: %s", tg_arn, e)
+        results['failed'].append({'arn': tg_arn, 'operation': 'describe_health', 'error': str(e)})
     
-    # Deregister from target groups that are not in the provided list
-    logger.info("Deregistering from unwanted target groups...")
-    for tg in results['already_registered']:
-        if tg not in [tg['arn'] for tg in target_groups]:
-            try:
-                elb_client.deregister_targets(TargetGroupArn=tg, Targets=[{'Id': instance_id}])
-                results['deregistered'].append(tg)
-                logger.info(f"Successfully deregistered from {tg}")
-            except Exception as e:
-                logger.error(f"Failed to deregister from {tg}: {e}")
-                results['failed'].append({'arn': tg, 'operation': 'deregister', 'error': str(e)})
-    
-    # Register to new target groups
-    logger.info("Registering to new target groups...")
-    for tg in target_groups:
-        if tg['arn'] not in results['already_registered']:
-            try:
-                elb_client.register_targets(TargetGroupArn=tg['arn'], Targets=[{'Id': instance_id}])
-                results['registered'].append(tg['arn'])
-                logger.info(f"Successfully registered to {tg['arn']}")
-            except Exception as e:
-                logger.error(f"Failed to register to {tg['arn']}: {e}")
-                results['failed'].append({'arn': tg['arn'], 'operation': 'register', 'error': str(e)})
+    to_deregister, to_register = plan_instance_changes(already_set, target_groups)
+    changes = apply_target_group_changes(
+        elb_client,
+        {tg_arn: [instance_id] for tg_arn in to_register},
+        {tg_arn: [instance_id] for tg_arn in to_deregister},
+        logger
+    )
+    results['registered'].extend(changes['registered'])
+    results['deregistered'].extend(changes['deregistered'])
+    results['failed'].extend(changes['failed'])
     
     return results
 
+# Work out which target groups an instance has to leave and join, given the set of
+# target group ARNs it is already registered to and the desired ARN -> port dict
+def plan_instance_changes(already_set, target_groups):
+    to_deregister = sorted(already_set - target_groups.keys())
+    to_register = [tg_arn for tg_arn in target_groups if tg_arn not in already_set]
+    return to_deregister, to_register
+
+# Send one batched register/deregister call for a target group. AWS rejects the whole
+# call if any target is invalid (e.g. a spot instance that is already gone), so on an
+# InvalidTarget rejection each instance is retried on its own and failures are reported
+# per instance. Returns (succeeded instance IDs, [(failed instance IDs, error)])
+def _write_targets(operation, tg_arn, instance_ids):
+    try:
+        operation(TargetGroupArn=tg_arn, Targets=[{'Id': iid} for iid in instance_ids])
+        return list(instance_ids), []
+    except Exception as e:
+        # Only an InvalidTarget rejection is specific to some of the instances; any other
+        # error (throttling, permissions, missing target group) fails the whole batch
+        if len(instance_ids) == 1 or not _is_invalid_target(e):
+            return [], [(list(instance_ids), e)]
+
+    succeeded, failures = [], []
+    for iid in instance_ids:
+        try:
+            operation(TargetGroupArn=tg_arn, Targets=[{'Id': iid}])
+            succeeded.append(iid)
+        except Exception as e:
+            failures.append(([iid], e))
+    return succeeded, failures
+
+# Apply pending changes, given as target group ARN -> instance IDs, with one
+# deregister_targets/register_targets call per target group. With wait_in_service
+# set, newly registered targets are waited on until they pass health checks
+def apply_target_group_changes(elb_client, to_register, to_deregister, logger, wait_in_service=False):
+    results = {'registered': {}, 'deregistered': {}, 'failed': []}
+
+    # Deregister/register calls are independent round-trips, so overlap them on a shared client
+    with ThreadPoolExecutor(max_workers=AWS_CONCURRENCY) as executor:
+        # Deregister from target groups that are not in the provided list
+        logger.info("Deregistering from unwanted target groups...")
+        futures = {
+            executor.submit(_write_targets, elb_client.deregister_targets, tg_arn, instance_ids): tg_arn
+            for tg_arn, instance_ids in to_deregister.items()
+        }
+        for future in as_completed(futures):
+            tg_arn = futures[future]
+            succeeded, failures = future.result()
+            if succeeded:
+                results['deregistered'][tg_arn] = succeeded
+                logger.info("Successfully deregistered %s from %s", succeeded, tg_arn)
+            for instance_ids, e in failures:
+                logger.error("Failed to deregister %s from %s: %s", instance_ids, tg_arn, e)
+                results['failed'].append({'arn': tg_arn, 'operation': 'deregister', 'instances': instance_ids, 'error': str(e)})
+
+        # Register to new target groups
+        logger.info("Registering to new target groups...")
+        futures = {
+            executor.submit(_write_targets, elb_client.register_targets, tg_arn, instance_ids): tg_arn
+            for tg_arn, instance_ids in to_register.items()
+        }
+        for future in as_completed(futures):
+            tg_arn = futures[future]
+            succeeded, failures = future.result()
+            if succeeded:
+                results['registered'][tg_arn] = succeeded
+                logger.info("Successfully registered %s to %s", succeeded, tg_arn)
+            for instance_ids, e in failures:
+                logger.error("Failed to register %s to %s: %s", instance_ids, tg_arn, e)
+                results['failed'].append({'arn': tg_arn, 'operation': 'register', 'instances': instance_ids, 'error': str(e)})
+
+        if wait_in_service and results['registered']:
+            logger.info("Waiting for registered targets to come into service...")
+            waiter = elb_client.get_waiter('target_in_service')
+            futures = {
+                executor.submit(
+                    waiter.wait,
+                    TargetGroupArn=tg_arn,
+                    Targets=[{'Id': iid} for iid in instance_ids],
+                    WaiterConfig=IN_SERVICE_WAITER_CONFIG
+                ): tg_arn
+                for tg_arn, instance_ids in results['registered'].items()
+            }
+            for future in as_completed(futures):
+                tg_arn = futures[future]
+                try:
+                    future.result()
+                    logger.info("Targets %s are in service in %s", results['registered'][tg_arn], tg_arn)
+                except Exception as e:
+                    # Registration itself succeeded; health is re-checked on the next run
+                    logger.warning("Targets %s not yet in service in %s: %s", results['registered'][tg_arn], tg_arn, e)
+
+    return results
+
 # Main workflow execution
 def main():
     api_key = os.getenv("API_KEY")
     cluster_id = os.getenv("CLUSTER_ID")
     aws_region = os.getenv("AWS_REGION")
+    wait_in_service = os.getenv("WAIT_FOR_IN_SERVICE", "false").lower() == "true"
+    filter_by_tag = os.getenv("FILTER_TARGET_GROUPS_BY_TAG", "false").lower() == "true"
 
     if not all([api_key, cluster_id, aws_region]):
         logger.critical("[ERROR] Missing required environment variables")
         return
     
     logger.info("Fetching cluster nodes...***")
-    try:
-        cluster_nodes = get_cluster_nodes(api_key, cluster_id, logger)
-    except Exception as e:
-        logger.error(f"Failed to fetch cluster nodes: {e}")
+    cluster_nodes = get_cluster_nodes(api_key, cluster_id, logger)
+    if cluster_nodes is None:
+        logger.error("Failed to fetch cluster nodes")
         return  # Exit and move to the next iteration of the while loop
 
     if not cluster_nodes:
@@ -163,53 +496,94 @@ def main():
         return
 
     logger.info("Processing nodes...")
-    for node in cluster_nodes:
-        node_state = node['state']['phase']
-        labels = node.get('labels', {})
+    managed_nodes = list(_managed(cluster_nodes))
+    logger.info("Found %s ready CAST.AI managed nodes out of %s", len(managed_nodes), len(cluster_nodes))
+
+    if not managed_nodes:
+        logger.info("No CAST.AI managed nodes to process")
+        return
+
+    # Node configuration lookups are independent, so issue them concurrently. Nodes sharing a
+    # configuration share its lookup; the cache only lives for this run so changes are picked up
+    cfg_cache = {}
+    with ThreadPoolExecutor(max_workers=HTTP_CONCURRENCY) as executor:
+        for _, _, _, config_id in managed_nodes:
+            if config_id not in cfg_cache:
+                cfg_cache[config_id] = executor.submit(get_target_groups_for_node, api_key, cluster_id, config_id, logger)
+    for config_id, future in cfg_cache.items():
+        try:
+            cfg_cache[config_id] = future.result()
+        except Exception as e:
+            logger.error("Failed to get target groups for node config %s: %s", config_id, e)
+            cfg_cache[config_id] = None
+
+    # Scan target group registrations once for all nodes in this run
+    elb_client = _elb(aws_region)
+    try:
+        tg_descriptions = None
+        desired_arns = {tg_arn for target_groups in cfg_cache.values() if target_groups for tg_arn in target_groups}
+        if filter_by_tag:
+            # Only target groups tagged for this cluster are scanned, plus every desired group so
+            # that existing registrations to untagged ones are seen and not re-registered each run
+            tg_descriptions = list_cluster_target_groups(elb_client, aws_region, cluster_id)
+            scanned = {tg['TargetGroupArn'] for tg in tg_descriptions}
+            tg_descriptions = tg_descriptions + [{'TargetGroupArn': tg_arn} for tg_arn in sorted(desired_arns - scanned)]
+        discovery = build_registration_index(
+            elb_client, [instance_id for _, instance_id, _, _ in managed_nodes], tg_descriptions, desired_arns
+        )
+    except Exception as e:
+        logger.error("Failed to describe target groups: %s", e)
+        return
+    registry, errors = discovery
+    for tg_arn, e in errors:
+        logger.error("Error checking target group %s: %s", tg_arn, e)
+
+    # Collect changes across all nodes so each target group gets a single write per operation
+    to_register, to_deregister = defaultdict(list), defaultdict(list)
+    for _, instance_id, name, config_id in managed_nodes:
+        logger.info("Processing node %s (%s)", name, instance_id)
         
-        if labels.get('provisioner.cast.ai/managed-by') == "cast.ai" and node_state == "ready":
-            node_info = {
-                'id': node['id'],
-                'instance_id': node['instanceId'],
-                'name': node['name'],
-                'config_id': labels.get('provisioner.cast.ai/node-configuration-id')
-            }
+        target_groups = cfg_cache[config_id]
+        if target_groups is None:
+            logger.error("Failed to get target groups for node %s", name)
+            continue  # Continue to the next iteration of the for loop
+        
+        if not target_groups:
+            # Report-only path: existing registrations are left in place
+            result = register_instance_to_target_groups(aws_region, instance_id, target_groups, logger, discovery)
+            logger.info("Operation results for %s: %s", name, result)
+            continue
 
-            logger.info(f"Processing node {node_info['name']} ({node_info['instance_id']})")
-            
-            try:
-                target_groups = get_target_groups_for_node(api_key, cluster_id, node_info['config_id'], logger)
-            except Exception as e:
-                logger.error(f"Failed to get target groups for node {node_info['name']}: {e}")
-                continue  # Continue to the next iteration of the for loop
-            
-            # if not target_groups:
-            #     logger.warning(f"No target groups for node {node_info['name']}")
-            #     continue  # Skip to next iteration of the for loop
+        node_deregister, node_register = plan_instance_changes(registry.get(instance_id, set()), target_groups)
+        for tg_arn in node_deregister:
+            to_deregister[tg_arn].append(instance_id)
+        for tg_arn in node_register:
+            to_register[tg_arn].append(instance_id)
+        logger.info("Planned changes for %s: register %s, deregister %s", name, node_register, node_deregister)
 
-            try:
-                result = register_instance_to_target_groups(aws_region, node_info['instance_id'], target_groups, logger)
-                logger.info(f"Operation results for {node_info['name']}: {result}")
-            except Exception as e:
-                logger.error(f"Failed to register instance to target groups for node {node_info['name']}: {e}")
-                continue  # Skip to next iteration of the for loop
-        else:
-            logger.info(f"Skipping non-CAST.AI managed node {node['name']}")
+    try:
+        result = apply_target_group_changes(elb_client, to_register, to_deregister, logger, wait_in_service)
+        logger.info("Operation results: %s", result)
+    except Exception as e:
+        logger.error("Failed to apply target group changes: %s", e)
 
-# Run the process repeatedly with a delay
+# Run the process repeatedly on a fixed 60 second cadence
 if __name__ == "__main__":
     logger = configure_logging()
     
+    next_tick = time.monotonic()
     while True:
         try:
             main()
-            logger.info("Waiting 60 seconds before next execution...")
-            time.sleep(60)
         except Exception as e:
-            logger.error(f"Unexpected error: {e}")
-            logger.info("Waiting 60 seconds before retry...")
-            time.sleep(60)
-
-
-
+            logger.error("Unexpected error: %s", e)
 
+        # Schedule against a monotonic deadline so the run time of main() does not add drift
+        next_tick += 60
+        delay = next_tick - time.monotonic()
+        if delay > 0:
+            logger.info("Waiting %.1f seconds before next execution...", delay)
+            time.sleep(delay)
+        else:
+            logger.warning("Tick overrun by %.1f seconds, starting next execution immediately", -delay)
+            next_tick = time.monotonic()
@@ -1,25 +1,35 @@
 
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, ANY
 import logging
+import orjson
 import requests
 import boto3
+from botocore.exceptions import ClientError
+import src.main
 from src.main import (
+    _elb,
+    _managed,
     configure_logging,
+    main,
     fetch_data,
     get_cluster_nodes,
     get_target_groups_for_node,
-    register_instance_to_target_groups
+    register_instance_to_target_groups,
+    apply_target_group_changes,
+    build_registration_index,
+    list_cluster_target_groups
 )
 
 # Sample Tests
 class TestMainModule(unittest.TestCase):
 
-    # Set up the logger to test logging outputs
-    def setUp(self):
-        self.logger = configure_logging()
+    # Set up the logger once to test logging outputs
+    @classmethod
+    def setUpClass(cls):
+        cls.logger = configure_logging()
 
-    @patch('requests.get')
+    @patch('src.main.SESSION.get')
     def test_fetch_data_success(self, mock_get):
         """
         Test Case: Successful API Response Handling
@@ -28,27 +38,29 @@ class TestMainModule(unittest.TestCase):
         """
         mock_response = MagicMock()
         mock_response.status_code = 200
-        mock_response.json.return_value = {'data': 'test'}
+        mock_response.content = orjson.dumps({'data': 'test'})
         mock_get.return_value = mock_response
 
-        result = fetch_data('https://testurl.com', {'Header': 'value'}, logger=self.logger)
+        ok, result = fetch_data('https://testurl.com', {'Header': 'value'}, logger=self.logger)
+        self.assertTrue(ok)  # Ensure the request is reported as successful
         self.assertEqual(result, {'data': 'test'})  # Ensure correct data is returned
-        mock_get.assert_called_once_with('https://testurl.com', headers={'Header': 'value'}, params=None)  # Ensure the API call was made correctly
+        mock_get.assert_called_once_with('https://testurl.com', headers={'Header': 'value'}, params=None, timeout=(3.05, 30))  # Ensure the API call was made correctly
 
-    @patch('requests.get')
+    @patch('src.main.SESSION.get')
     def test_fetch_data_failure(self, mock_get):
         """
         Test Case: Failure Handling in fetch_data
         This test simulates a failure in the API request by raising a RequestException,
-        and ensures that fetch_data returns None and logs the failure.
+        and ensures that fetch_data reports the failure and returns no data.
         """
         mock_get.side_effect = requests.exceptions.RequestException("API request failed")
 
-        result = fetch_data('https://testurl.com', {'Header': 'value'}, logger=self.logger)
+        ok, result = fetch_data('https://testurl.com', {'Header': 'value'}, logger=self.logger)
+        self.assertFalse(ok)  # Ensure the failure is reported
         self.assertIsNone(result)  # Ensure None is returned on failure
         mock_get.assert_called_once()  # Ensure that the API call was made
 
-    @patch('requests.get')
+    @patch('src.main.SESSION.get')
     def test_get_cluster_nodes(self, mock_get):
         """
         Test Case: Retrieve Cluster Nodes
@@ -57,7 +69,7 @@ class TestMainModule(unittest.TestCase):
         """
         mock_response = MagicMock()
         mock_response.status_code = 200
-        mock_response.json.return_value = {'items': [{'id': 'node1'}, {'id': 'node2'}]}
+        mock_response.content = orjson.dumps({'items': [{'id': 'node1'}, {'id': 'node2'}]})
         mock_get.return_value = mock_response
 
         api_key = 'test_api_key'
@@ -66,7 +78,7 @@ class TestMainModule(unittest.TestCase):
         self.assertEqual(len(result), 2)  # Ensure two nodes are returned
         mock_get.assert_called_once()  # Ensure the API call was made correctly
 
-    @patch('requests.get')
+    @patch('src.main.SESSION.get')
     def test_get_target_groups_for_node(self, mock_get):
         """
         Test Case: Retrieve Target Groups for a Node
@@ -75,25 +87,59 @@ class TestMainModule(unittest.TestCase):
         """
         mock_response = MagicMock()
         mock_response.status_code = 200
-        mock_response.json.return_value = {
+        mock_response.content = orjson.dumps({
             'eks': {
                 'targetGroups': [
                     {'arn': 'tg_arn_1', 'port': 80},
                     {'arn': 'tg_arn_2', 'port': 443}
                 ]
             }
-        }
+        })
         mock_get.return_value = mock_response
 
         api_key = 'test_api_key'
         cluster_id = 'test_cluster_id'
         node_config_id = 'test_node_config_id'
         result = get_target_groups_for_node(api_key, cluster_id, node_config_id, self.logger)
-        self.assertEqual(len(result), 2)  # Ensure two target groups are returned
+        self.assertEqual(result, {'tg_arn_1': 80, 'tg_arn_2': 443})  # Ensure both target groups are returned by ARN
         mock_get.assert_called_once()  # Ensure the API call was made correctly
 
-    @patch('boto3.client')
-    def test_register_instance_to_target_groups(self, mock_boto_client):
+    @patch('src.main.SESSION.get')
+    def test_get_target_groups_for_node_failure(self, mock_get):
+        """
+        Test Case: Node Configuration Request Failure
+        This test checks that a failed node configuration request is reported as None rather than
+        an empty result, so callers do not mistake it for a configuration without target groups.
+        """
+        mock_get.side_effect = requests.exceptions.RequestException("API request failed")
+
+        result = get_target_groups_for_node('test_api_key', 'test_cluster_id', 'test_node_config_id', self.logger)
+        self.assertIsNone(result)
+
+    @patch('src.main.SESSION.get')
+    def test_get_target_groups_for_node_malformed_payload(self, mock_get):
+        """
+        Test Case: Null or Malformed Node Configuration
+        This test checks that null sections are treated as no target groups, while payloads of
+        an unexpected shape are reported as a failed lookup instead of raising.
+        """
+        cases = [
+            ({'eks': None}, {}),
+            ({'eks': {'targetGroups': None}}, {}),
+            ({'eks': 'unexpected'}, None),
+            ({'eks': {'targetGroups': 'unexpected'}}, None),
+            (['unexpected'], None)
+        ]
+        for payload, expected in cases:
+            mock_response = MagicMock()
+            mock_response.content = orjson.dumps(payload)
+            mock_get.return_value = mock_response
+
+            result = get_target_groups_for_node('test_api_key', 'test_cluster_id', 'test_node_config_id', self.logger)
+            self.assertEqual(result, expected, payload)
+
+    @patch('src.main._elb')
+    def test_register_instance_to_target_groups(self, mock_elb):
         """
         Test Case: Register Instance to Target Groups
         This test simulates the scenario where an instance is registered to a new target group 
@@ -101,12 +147,10 @@ class TestMainModule(unittest.TestCase):
         services (e.g., boto3 client for registering/deregistering instances).
         """
         mock_elb_client = MagicMock()
-        mock_boto_client.return_value = mock_elb_client
+        mock_elb.return_value = mock_elb_client
         
-        # Mock paginator to simulate AWS responses for target groups
-        mock_paginator = MagicMock()
-        mock_paginator.paginate.return_value = [{'TargetGroups': [{'TargetGroupArn': 'tg_arn_1'}]}]
-        mock_elb_client.get_paginator.return_value = mock_paginator
+        # Mock describe_target_groups to simulate a single page of target groups
+        mock_elb_client.describe_target_groups.return_value = {'TargetGroups': [{'TargetGroupArn': 'tg_arn_1'}]}
 
         # Mock describe_target_health to indicate the instance is registered in 'tg_arn_1'
         mock_elb_client.describe_target_health.return_value = {
@@ -121,34 +165,35 @@ class TestMainModule(unittest.TestCase):
 
         aws_region = 'us-west-1'
         instance_id = 'test_instance_id'
-        target_groups = [{'arn': 'tg_arn_2', 'port': 80}]  # Target group to register to
+        target_groups = {'tg_arn_2': 80}  # Target group to register to
 
         result = register_instance_to_target_groups(aws_region, instance_id, target_groups, self.logger)
         self.assertIn('registered', result)
         self.assertIn('already_registered', result)
         self.assertIn('deregistered', result)
         self.assertIn('failed', result)
-        mock_boto_client.assert_called_once_with('elbv2', region_name=aws_region)
+        mock_elb.assert_called_once_with(aws_region)
 
-    @patch('boto3.client')
-    def test_register_instance_no_target_groups(self, mock_boto_client):
+    @patch('src.main._elb')
+    def test_register_instance_no_target_groups(self, mock_elb):
         """
         Test Case: No Target Groups Provided
         This test checks the behavior when no target groups are provided in the input. 
         The function should not attempt any AWS operations and return empty results.
         """
         mock_elb_client = MagicMock()
-        mock_boto_client.return_value = mock_elb_client
+        mock_elb.return_value = mock_elb_client
+        mock_elb_client.describe_target_groups.return_value = {'TargetGroups': []}
 
         aws_region = 'us-west-1'
         instance_id = 'test_instance_id'
-        target_groups = []  # No target groups provided
+        target_groups = {}  # No target groups provided
 
         result = register_instance_to_target_groups(aws_region, instance_id, target_groups, self.logger)
         self.assertEqual(result, {'registered': [], 'already_registered': [], 'deregistered': [], 'failed': []})
 
-    @patch('boto3.client')
-    def test_partial_registration_success(self, mock_boto_client):
+    @patch('src.main._elb')
+    def test_partial_registration_success(self, mock_elb):
         """
         Test Case: Partial Registration Success
         This test simulates a situation where the instance is successfully registered to one target 
@@ -156,19 +201,23 @@ class TestMainModule(unittest.TestCase):
         correctly and logs the failed registration attempt.
         """
         mock_elb_client = MagicMock()
-        mock_boto_client.return_value = mock_elb_client
+        mock_elb.return_value = mock_elb_client
+        mock_elb_client.describe_target_groups.return_value = {'TargetGroups': [{'TargetGroupArn': 'tg_arn_1'}, {'TargetGroupArn': 'tg_arn_2'}]}
 
         # Simulate AWS response where instance is not registered in both target groups
         mock_elb_client.describe_target_health.side_effect = [
             {'TargetHealthDescriptions': []},  # First target group: instance not registered
             {'TargetHealthDescriptions': []}   # Second target group: instance not registered
         ]
-        # Simulate register_targets where the first call succeeds and second fails
-        mock_elb_client.register_targets.side_effect = [None, Exception("Failed to register")]
+        # Simulate register_targets where tg_arn_1 succeeds and tg_arn_2 fails
+        def register_targets(TargetGroupArn, Targets):
+            if TargetGroupArn == 'tg_arn_2':
+                raise Exception("Failed to register")
+        mock_elb_client.register_targets.side_effect = register_targets
 
         aws_region = 'us-west-1'
         instance_id = 'test_instance_id'
-        target_groups = [{'arn': 'tg_arn_1', 'port': 80}, {'arn': 'tg_arn_2', 'port': 443}]
+        target_groups = {'tg_arn_1': 80, 'tg_arn_2': 443}
 
         result = register_instance_to_target_groups(aws_region, instance_id, target_groups, self.logger)
 
@@ -183,18 +232,19 @@ class TestMainModule(unittest.TestCase):
         self.assertEqual(result['already_registered'], [])
         self.assertEqual(result['deregistered'], [])
 
-        # Assert boto3 client was called with the correct parameters
-        mock_boto_client.assert_called_once_with('elbv2', region_name=aws_region)
+        # Assert the ELBv2 client was requested for the correct region
+        mock_elb.assert_called_once_with(aws_region)
 
-    @patch('boto3.client')
-    def test_register_instance_target_groups_success(self, mock_boto_client):
+    @patch('src.main._elb')
+    def test_register_instance_target_groups_success(self, mock_elb):
         """
         Test Case: Successful Registration to a New Target Group
         This test checks if the instance is correctly registered to a target group when it's not
         already registered and no errors occur.
         """
         mock_elb_client = MagicMock()
-        mock_boto_client.return_value = mock_elb_client
+        mock_elb.return_value = mock_elb_client
+        mock_elb_client.describe_target_groups.return_value = {'TargetGroups': [{'TargetGroupArn': 'tg_arn_1'}]}
 
         # Mock describe_target_health to indicate the instance is not registered in any target groups
         mock_elb_client.describe_target_health.side_effect = [
@@ -206,7 +256,7 @@ class TestMainModule(unittest.TestCase):
 
         aws_region = 'us-west-1'
         instance_id = 'test_instance_id'
-        target_groups = [{'arn': 'tg_arn_1', 'port': 80}]  # New target group to register to
+        target_groups = {'tg_arn_1': 80}  # New target group to register to
 
         result = register_instance_to_target_groups(aws_region, instance_id, target_groups, self.logger)
 
@@ -216,35 +266,37 @@ class TestMainModule(unittest.TestCase):
         self.assertEqual(result['deregistered'], [])
         self.assertEqual(result['failed'], [])
 
-        mock_boto_client.assert_called_once_with('elbv2', region_name=aws_region)
+        mock_elb.assert_called_once_with(aws_region)
 
-    @patch('boto3.client')
-    def test_register_instance_no_target_groups_empty(self, mock_boto_client):
+    @patch('src.main._elb')
+    def test_register_instance_no_target_groups_empty(self, mock_elb):
         """
-        Test Case: No Target Groups Provided (Empty List)
+        Test Case: No Target Groups Provided (Empty Mapping)
         This test checks the behavior when no target groups are provided in the input.
         """
         mock_elb_client = MagicMock()
-        mock_boto_client.return_value = mock_elb_client
+        mock_elb.return_value = mock_elb_client
+        mock_elb_client.describe_target_groups.return_value = {'TargetGroups': []}
 
         aws_region = 'us-west-1'
         instance_id = 'test_instance_id'
-        target_groups = []  # No target groups provided
+        target_groups = {}  # No target groups provided
 
         result = register_instance_to_target_groups(aws_region, instance_id, target_groups, self.logger)
 
         # Ensure that no operations were performed
         self.assertEqual(result, {'registered': [], 'already_registered': [], 'deregistered': [], 'failed': []})
-        mock_boto_client.assert_called_once_with('elbv2', region_name=aws_region)
+        mock_elb.assert_called_once_with(aws_region)
 
-    @patch('boto3.client')
-    def test_register_instance_with_target_groups_partial_success(self, mock_boto_client):
+    @patch('src.main._elb')
+    def test_register_instance_with_target_groups_partial_success(self, mock_elb):
         """
         Test Case: Partial Success in Registration
         This test simulates a situation where one target group registration succeeds and another fails.
         """
         mock_elb_client = MagicMock()
-        mock_boto_client.return_value = mock_elb_client
+        mock_elb.return_value = mock_elb_client
+        mock_elb_client.describe_target_groups.return_value = {'TargetGroups': [{'TargetGroupArn': 'tg_arn_1'}, {'TargetGroupArn': 'tg_arn_2'}]}
 
         # Simulate instance not registered to any target groups
         mock_elb_client.describe_target_health.side_effect = [
@@ -253,14 +305,14 @@ class TestMainModule(unittest.TestCase):
         ]
 
         # Simulate successful registration to tg_arn_1, failure to register tg_arn_2
-        mock_elb_client.register_targets.side_effect = [
-            None,  # Successful registration to tg_arn_1
-            Exception("Failed to register tg_arn_2")  # Failure for tg_arn_2
-        ]
+        def register_targets(TargetGroupArn, Targets):
+            if TargetGroupArn == 'tg_arn_2':
+                raise Exception("Failed to register tg_arn_2")
+        mock_elb_client.register_targets.side_effect = register_targets
 
         aws_region = 'us-west-1'
         instance_id = 'test_instance_id'
-        target_groups = [{'arn': 'tg_arn_1', 'port': 80}, {'arn': 'tg_arn_2', 'port': 443}]
+        target_groups = {'tg_arn_1': 80, 'tg_arn_2': 443}
 
         result = register_instance_to_target_groups(aws_region, instance_id, target_groups, self.logger)
 
@@ -269,17 +321,18 @@ class TestMainModule(unittest.TestCase):
         # Ensure tg_arn_2 failed to register
         self.assertIn('tg_arn_2', [item['arn'] for item in result['failed']])
 
-        mock_boto_client.assert_called_once_with('elbv2', region_name=aws_region)
+        mock_elb.assert_called_once_with(aws_region)
 
 
-    @patch('boto3.client')
-    def test_register_instance_invalid_target_group(self, mock_boto_client):
+    @patch('src.main._elb')
+    def test_register_instance_invalid_target_group(self, mock_elb):
         """
         Test Case: Invalid Target Group ARN
         This test checks the case where the target group ARN is invalid or does not exist.
         """
         mock_elb_client = MagicMock()
-        mock_boto_client.return_value = mock_elb_client
+        mock_elb.return_value = mock_elb_client
+        mock_elb_client.describe_target_groups.return_value = {'TargetGroups': [{'TargetGroupArn': 'tg_arn_1'}]}
 
         # Simulate instance not registered to any target groups
         mock_elb_client.describe_target_health.side_effect = [
@@ -291,7 +344,7 @@ class TestMainModule(unittest.TestCase):
 
         aws_region = 'us-west-1'
         instance_id = 'test_instance_id'
-        target_groups = [{'arn': 'invalid_tg_arn', 'port': 80}]  # Invalid ARN
+        target_groups = {'invalid_tg_arn': 80}  # Invalid ARN
 
         result = register_instance_to_target_groups(aws_region, instance_id, target_groups, self.logger)
 
@@ -301,15 +354,16 @@ class TestMainModule(unittest.TestCase):
         self.assertEqual(result['already_registered'], [])
         self.assertEqual(result['deregistered'], [])
 
-    @patch('boto3.client')
-    def test_deregister_instance_no_target_groups(self, mock_boto_client):
+    @patch('src.main._elb')
+    def test_deregister_instance_no_target_groups(self, mock_elb):
         """
         Test Case: Deregister Instance When No Target Groups Provided
-        This test checks the behavior when the target_groups list is empty, and the instance should be
+        This test checks the behavior when target_groups is empty, and the instance should be
         deregistered from all existing target groups.
         """
         mock_elb_client = MagicMock()
-        mock_boto_client.return_value = mock_elb_client
+        mock_elb.return_value = mock_elb_client
+        mock_elb_client.describe_target_groups.return_value = {'TargetGroups': [{'TargetGroupArn': 'tg_arn_1'}]}
 
         # Simulate instance already registered in one target group
         mock_elb_client.describe_target_health.return_value = {
@@ -321,7 +375,7 @@ class TestMainModule(unittest.TestCase):
 
         aws_region = 'us-west-1'
         instance_id = 'test_instance_id'
-        target_groups = []  # No target groups provided, expect deregistration
+        target_groups = {}  # No target groups provided, expect deregistration
 
         result = register_instance_to_target_groups(aws_region, instance_id, target_groups, self.logger)
 
@@ -331,8 +385,519 @@ class TestMainModule(unittest.TestCase):
         self.assertEqual(result['already_registered'], [])
         self.assertEqual(result['failed'], [])
 
-        mock_boto_client.assert_called_once_with('elbv2', region_name=aws_region)
+        mock_elb.assert_called_once_with(aws_region)
+
+    @patch('src.main._elb')
+    def test_discovery_error_isolated_per_target_group(self, mock_elb):
+        """
+        Test Case: Health Check Failure for One Target Group
+        This test checks that a describe_target_health failure on one target group is reported
+        as a failure without preventing discovery on the remaining target groups.
+        """
+        mock_elb_client = MagicMock()
+        mock_elb.return_value = mock_elb_client
+
+        mock_elb_client.describe_target_groups.return_value = {'TargetGroups': [{'TargetGroupArn': 'tg_arn_1'}, {'TargetGroupArn': 'tg_arn_2'}]}
+
+        # tg_arn_1 cannot be described, tg_arn_2 already holds the instance
+        def describe_target_health(TargetGroupArn, Targets=None):
+            if TargetGroupArn == 'tg_arn_1':
+                raise Exception("Access denied")
+            return {'TargetHealthDescriptions': [{'Target': {'Id': 'test_instance_id'}}]}
+        mock_elb_client.describe_target_health.side_effect = describe_target_health
+
+        aws_region = 'us-west-1'
+        instance_id = 'test_instance_id'
+        target_groups = {'tg_arn_2': 80}
+
+        result = register_instance_to_target_groups(aws_region, instance_id, target_groups, self.logger)
+
+        self.assertEqual(result['already_registered'], ['tg_arn_2'])
+        self.assertEqual(result['registered'], [])
+        self.assertEqual(result['failed'], [{'arn': 'tg_arn_1', 'operation': 'describe_health', 'error': 'Access denied'}])
+        mock_elb_client.register_targets.assert_not_called()
+
+    @patch('src.main._elb')
+    def test_register_instance_with_cached_discovery(self, mock_elb):
+        """
+        Test Case: Precomputed Discovery
+        This test checks that when a discovery result is passed in, the function derives the
+        current registrations from it without issuing any describe calls to AWS.
+        """
+        mock_elb_client = MagicMock()
+        mock_elb.return_value = mock_elb_client
+
+        discovery = ({'test_instance_id': {'tg_arn_1'}, 'other_instance_id': {'tg_arn_2'}}, [])
+
+        aws_region = 'us-west-1'
+        instance_id = 'test_instance_id'
+        target_groups = {'tg_arn_2': 80}
+
+        result = register_instance_to_target_groups(aws_region, instance_id, target_groups, self.logger, discovery)
+
+        self.assertEqual(result['already_registered'], ['tg_arn_1'])
+        self.assertEqual(result['deregistered'], ['tg_arn_1'])
+        self.assertEqual(result['registered'], ['tg_arn_2'])
+        mock_elb_client.describe_target_groups.assert_not_called()
+        mock_elb_client.describe_target_health.assert_not_called()
+
+    def test_apply_target_group_changes_batches_by_target_group(self):
+        """
+        Test Case: Batched Writes
+        This test checks that pending changes for several instances are sent as a single
+        register/deregister call per target group.
+        """
+        mock_elb_client = MagicMock()
+
+        to_register = {'tg_arn_1': ['instance_a', 'instance_b']}
+        to_deregister = {'tg_arn_2': ['instance_a']}
+
+        result = apply_target_group_changes(mock_elb_client, to_register, to_deregister, self.logger)
+
+        mock_elb_client.register_targets.assert_called_once_with(
+            TargetGroupArn='tg_arn_1', Targets=[{'Id': 'instance_a'}, {'Id': 'instance_b'}]
+        )
+        mock_elb_client.deregister_targets.assert_called_once_with(
+            TargetGroupArn='tg_arn_2', Targets=[{'Id': 'instance_a'}]
+        )
+        self.assertEqual(result, {
+            'registered': {'tg_arn_1': ['instance_a', 'instance_b']},
+            'deregistered': {'tg_arn_2': ['instance_a']},
+            'failed': []
+        })
+
+    @patch('src.main._elb')
+    def test_discovery_follows_next_marker(self, mock_elb):
+        """
+        Test Case: Paginated Target Group Listing
+        This test checks that discovery keeps requesting pages of target groups until
+        describe_target_groups stops returning a NextMarker.
+        """
+        mock_elb_client = MagicMock()
+        mock_elb.return_value = mock_elb_client
+
+        mock_elb_client.describe_target_groups.side_effect = [
+            {'TargetGroups': [{'TargetGroupArn': 'tg_arn_1'}], 'NextMarker': 'page_2'},
+            {'TargetGroups': [{'TargetGroupArn': 'tg_arn_2'}]}
+        ]
+        mock_elb_client.describe_target_health.return_value = {
+            'TargetHealthDescriptions': [{'Target': {'Id': 'test_instance_id'}}]
+        }
+
+        aws_region = 'us-west-1'
+        instance_id = 'test_instance_id'
+        target_groups = {'tg_arn_1': 80, 'tg_arn_2': 443}
+
+        result = register_instance_to_target_groups(aws_region, instance_id, target_groups, self.logger)
+
+        self.assertEqual(result['already_registered'], ['tg_arn_1', 'tg_arn_2'])
+        mock_elb_client.describe_target_groups.assert_any_call(PageSize=400)
+        mock_elb_client.describe_target_groups.assert_any_call(PageSize=400, Marker='page_2')
 
+    @patch('src.main._elb')
+    def test_discovery_queries_only_requested_targets(self, mock_elb):
+        """
+        Test Case: Targeted Health Queries
+        This test checks that discovery only asks about the instance being processed in target
+        groups it is not meant to be in, and that AWS echoing the instance back as not registered
+        is not mistaken for a registration.
+        """
+        mock_elb_client = MagicMock()
+        mock_elb.return_value = mock_elb_client
+
+        mock_elb_client.describe_target_groups.return_value = {'TargetGroups': [{'TargetGroupArn': 'tg_arn_1'}, {'TargetGroupArn': 'tg_arn_2'}]}
+        mock_elb_client.describe_target_health.return_value = {
+            'TargetHealthDescriptions': [
+                {'Target': {'Id': 'test_instance_id'}, 'TargetHealth': {'State': 'unused', 'Reason': 'Target.NotRegistered'}}
+            ]
+        }
+
+        aws_region = 'us-west-1'
+        instance_id = 'test_instance_id'
+        target_groups = {'tg_arn_2': 80}
+
+        result = register_instance_to_target_groups(aws_region, instance_id, target_groups, self.logger)
+
+        self.assertEqual(result['already_registered'], [])
+        self.assertEqual(result['registered'], ['tg_arn_2'])
+        mock_elb_client.describe_target_health.assert_any_call(
+            TargetGroupArn='tg_arn_1', Targets=[{'Id': 'test_instance_id'}]
+        )
+
+    @patch('src.main._elb')
+    def test_discovery_sees_desired_registration_on_other_port(self, mock_elb):
+        """
+        Test Case: Registration on a Non-Default Port
+        This test checks that a desired target group is listed in full, so an instance registered
+        to it on a port other than the group's default is seen as already registered.
+        """
+        mock_elb_client = MagicMock()
+        mock_elb.return_value = mock_elb_client
+
+        mock_elb_client.describe_target_groups.return_value = {'TargetGroups': [{'TargetGroupArn': 'tg_arn_1'}]}
+        mock_elb_client.describe_target_health.return_value = {
+            'TargetHealthDescriptions': [
+                {'Target': {'Id': 'other_instance_id', 'Port': 80}, 'TargetHealth': {'State': 'healthy'}},
+                {'Target': {'Id': 'test_instance_id', 'Port': 8080}, 'TargetHealth': {'State': 'healthy'}}
+            ]
+        }
+
+        result = register_instance_to_target_groups('us-west-1', 'test_instance_id', {'tg_arn_1': 80}, self.logger)
+
+        self.assertEqual(result['already_registered'], ['tg_arn_1'])
+        self.assertEqual(result['registered'], [])
+        mock_elb_client.describe_target_health.assert_called_once_with(TargetGroupArn='tg_arn_1')
+        mock_elb_client.register_targets.assert_not_called()
+
+    def test_apply_target_group_changes_isolates_invalid_target(self):
+        """
+        Test Case: One Invalid Target in a Batch
+        This test checks that when AWS rejects a batched registration because one instance is
+        invalid, the remaining instances are still registered and only that instance is reported.
+        """
+        mock_elb_client = MagicMock()
+
+        invalid_target = ClientError({'Error': {'Code': 'InvalidTarget', 'Message': 'instance_c is not valid'}}, 'RegisterTargets')
+
+        def register_targets(TargetGroupArn, Targets):
+            if {'Id': 'instance_c'} in Targets:
+                raise invalid_target
+        mock_elb_client.register_targets.side_effect = register_targets
+
+        to_register = {'tg_arn_1': ['instance_a', 'instance_b', 'instance_c']}
+
+        result = apply_target_group_changes(mock_elb_client, to_register, {}, self.logger)
+
+        self.assertEqual(result['registered'], {'tg_arn_1': ['instance_a', 'instance_b']})
+        self.assertEqual(result['failed'], [
+            {'arn': 'tg_arn_1', 'operation': 'register', 'instances': ['instance_c'], 'error': str(invalid_target)}
+        ])
+        self.assertEqual(mock_elb_client.register_targets.call_count, 4)
+
+    def test_apply_target_group_changes_fails_whole_batch_on_other_errors(self):
+        """
+        Test Case: Batch Rejected for a Reason Other Than InvalidTarget
+        This test checks that an error such as throttling is not retried one instance at a time,
+        and that the whole batch is reported as failed.
+        """
+        mock_elb_client = MagicMock()
+        throttled = ClientError({'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'}}, 'RegisterTargets')
+        mock_elb_client.register_targets.side_effect = throttled
+
+        to_register = {'tg_arn_1': ['instance_a', 'instance_b', 'instance_c']}
+
+        result = apply_target_group_changes(mock_elb_client, to_register, {}, self.logger)
+
+        self.assertEqual(result['registered'], {})
+        self.assertEqual(result['failed'], [
+            {'arn': 'tg_arn_1', 'operation': 'register', 'instances': ['instance_a', 'instance_b', 'instance_c'], 'error': str(throttled)}
+        ])
+        mock_elb_client.register_targets.assert_called_once()
+
+    def test_apply_target_group_changes_waits_for_in_service(self):
+        """
+        Test Case: Waiting for Registered Targets
+        This test checks that when waiting is enabled, the target_in_service waiter is run for
+        every target group that was registered to, and that a waiter timeout is not a failure.
+        """
+        mock_elb_client = MagicMock()
+        mock_waiter = MagicMock()
+        mock_waiter.wait.side_effect = Exception("Max attempts exceeded")
+        mock_elb_client.get_waiter.return_value = mock_waiter
+
+        to_register = {'tg_arn_1': ['instance_a']}
+
+        result = apply_target_group_changes(mock_elb_client, to_register, {}, self.logger, wait_in_service=True)
+
+        mock_elb_client.get_waiter.assert_called_once_with('target_in_service')
+        mock_waiter.wait.assert_called_once_with(
+            TargetGroupArn='tg_arn_1', Targets=[{'Id': 'instance_a'}], WaiterConfig={'Delay': 5, 'MaxAttempts': 12}
+        )
+        self.assertEqual(result['registered'], {'tg_arn_1': ['instance_a']})
+        self.assertEqual(result['failed'], [])
+
+    @patch('boto3.Session')
+    def test_elb_client_cached_per_region(self, mock_session):
+        """
+        Test Case: Shared ELBv2 Clients
+        This test checks that one ELBv2 client is created per region and reused afterwards.
+        """
+        with patch.dict(src.main._ELB_CLIENTS, clear=True):
+            first = _elb('us-west-1')
+            second = _elb('us-west-1')
+            _elb('eu-west-1')
+
+        self.assertIs(first, second)
+        self.assertEqual(mock_session.return_value.client.call_count, 2)
+        mock_session.return_value.client.assert_any_call('elbv2', region_name='us-west-1', config=ANY)
+
+    def test_managed_node_filter(self):
+        """
+        Test Case: Managed Node Filtering
+        This test checks that only ready, CAST.AI managed nodes are yielded, including nodes
+        whose labels or state are missing.
+        """
+        nodes = [
+            {'id': 'n1', 'instanceId': 'i-1', 'name': 'node1', 'state': {'phase': 'ready'},
+             'labels': {'provisioner.cast.ai/managed-by': 'cast.ai', 'provisioner.cast.ai/node-configuration-id': 'cfg1'}},
+            {'id': 'n2', 'instanceId': 'i-2', 'name': 'node2', 'state': {'phase': 'draining'},
+             'labels': {'provisioner.cast.ai/managed-by': 'cast.ai'}},
+            {'id': 'n3', 'instanceId': 'i-3', 'name': 'node3', 'state': {'phase': 'ready'}, 'labels': None},
+            {'id': 'n4', 'instanceId': 'i-4', 'name': 'node4', 'labels': {'provisioner.cast.ai/managed-by': 'cast.ai'}}
+        ]
+
+        self.assertEqual(list(_managed(nodes)), [('n1', 'i-1', 'node1', 'cfg1')])
+
+    @patch('logging.basicConfig')
+    def test_configure_logging_is_idempotent(self, mock_basic_config):
+        """
+        Test Case: Repeated Logging Configuration
+        This test checks that configure_logging does not reconfigure logging when the root
+        logger already has handlers.
+        """
+        root = logging.getLogger()
+        handler = logging.NullHandler()
+        root.addHandler(handler)
+        try:
+            logger = configure_logging()
+        finally:
+            root.removeHandler(handler)
+
+        self.assertEqual(logger.name, 'src.main')
+        mock_basic_config.assert_not_called()
+
+    @patch('src.main.SESSION.get')
+    def test_get_target_groups_for_node_duplicates(self, mock_get):
+        """
+        Test Case: Duplicate Target Groups in Node Configuration
+        This test checks that a target group listed twice, or without a port, is collapsed into
+        a single ARN -> port entry or dropped respectively.
+        """
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.content = orjson.dumps({
+            'eks': {
+                'targetGroups': [
+                    {'arn': 'tg_arn_1', 'port': 80},
+                    {'arn': 'tg_arn_1', 'port': 80},
+                    {'arn': 'tg_arn_2'}
+                ]
+            }
+        })
+        mock_get.return_value = mock_response
+
+        result = get_target_groups_for_node('test_api_key', 'test_cluster_id', 'test_node_config_id', self.logger)
+        self.assertEqual(result, {'tg_arn_1': 80})
+
+    def test_list_cluster_target_groups(self):
+        """
+        Test Case: Tag-Filtered Target Groups
+        This test checks that only target groups tagged with the cluster ID are kept, that tags
+        are requested in chunks of 20 ARNs, and that the result is reused from the cache.
+        """
+        mock_elb_client = MagicMock()
+        tg_arns = [f'tg_arn_{i}' for i in range(25)]
+        mock_elb_client.describe_target_groups.return_value = {
+            'TargetGroups': [{'TargetGroupArn': arn} for arn in tg_arns]
+        }
+
+        def describe_tags(ResourceArns):
+            return {'TagDescriptions': [
+                {'ResourceArn': arn, 'Tags': [{'Key': 'castai:cluster-id', 'Value': 'test_cluster_id' if arn in ('tg_arn_3', 'tg_arn_21') else 'other'}]}
+                for arn in ResourceArns
+            ]}
+        mock_elb_client.describe_tags.side_effect = describe_tags
+
+        with patch.dict(src.main._TAGGED_TG_CACHE, clear=True):
+            first = list_cluster_target_groups(mock_elb_client, 'us-west-1', 'test_cluster_id')
+            second = list_cluster_target_groups(mock_elb_client, 'us-west-1', 'test_cluster_id')
+
+        self.assertEqual([tg['TargetGroupArn'] for tg in first], ['tg_arn_3', 'tg_arn_21'])
+        self.assertEqual(second, first)
+        self.assertEqual(mock_elb_client.describe_tags.call_count, 2)
+        mock_elb_client.describe_target_groups.assert_called_once()
+
+    def test_discovery_requeries_group_rejecting_one_instance(self):
+        """
+        Test Case: Invalid Instance in a Batched Health Query
+        This test checks that a target group rejecting the batched query because one instance
+        is invalid is re-queried with the valid instances, a group in another VPC is not re-queried, and a
+        group with a non-instance target type is never queried at all.
+        """
+        mock_elb_client = MagicMock()
+        mock_elb_client.describe_target_groups.return_value = {'TargetGroups': [
+            {'TargetGroupArn': 'tg_arn_1', 'TargetType': 'instance', 'VpcId': 'vpc-1'},
+            {'TargetGroupArn': 'tg_arn_2', 'TargetType': 'instance', 'VpcId': 'vpc-1'},
+            {'TargetGroupArn': 'tg_arn_3', 'TargetType': 'instance', 'VpcId': 'vpc-2'},
+            {'TargetGroupArn': 'tg_arn_4', 'TargetType': 'ip', 'VpcId': 'vpc-1'}
+        ]}
+        invalid_target = ClientError({'Error': {'Code': 'InvalidTarget', 'Message': 'invalid'}}, 'DescribeTargetHealth')
+
+        def describe_target_health(TargetGroupArn, Targets):
+            ids = [target['Id'] for target in Targets]
+            if TargetGroupArn == 'tg_arn_1':
+                return {'TargetHealthDescriptions': []}
+            if TargetGroupArn == 'tg_arn_2' and ids == ['instance_a']:
+                return {'TargetHealthDescriptions': [{'Target': {'Id': 'instance_a'}, 'TargetHealth': {'State': 'healthy'}}]}
+            raise invalid_target
+        mock_elb_client.describe_target_health.side_effect = describe_target_health
+
+        registry, errors = build_registration_index(mock_elb_client, ['instance_a', 'instance_gone'])
+
+        self.assertEqual(dict(registry), {'instance_a': {'tg_arn_2'}})
+        self.assertEqual(errors, [])
+        queried = [c.kwargs['TargetGroupArn'] for c in mock_elb_client.describe_target_health.call_args_list]
+        self.assertEqual(queried.count('tg_arn_2'), 4)  # batch, one probe per instance and the re-query
+        self.assertEqual(queried.count('tg_arn_3'), 1)
+        self.assertNotIn('tg_arn_4', queried)
+
+    @patch.dict('os.environ', {'API_KEY': 'test_api_key', 'CLUSTER_ID': 'test_cluster_id',
+                               'AWS_REGION': 'us-west-1', 'FILTER_TARGET_GROUPS_BY_TAG': 'true'})
+    @patch('src.main._elb')
+    @patch('src.main.SESSION.get')
+    def test_main_tag_filter_scans_untagged_desired_target_groups(self, mock_get, mock_elb):
+        """
+        Test Case: Tag Filtering with an Untagged Desired Target Group
+        This test checks that with tag filtering enabled, a desired target group without the
+        cluster tag is still scanned, so an instance already registered to it is not registered again.
+        """
+        nodes = {'items': [{
+            'id': 'node1', 'instanceId': 'instance_a', 'name': 'node1', 'state': {'phase': 'ready'},
+            'labels': {'provisioner.cast.ai/managed-by': 'cast.ai', 'provisioner.cast.ai/node-configuration-id': 'cfg1'}
+        }]}
+        config = {'eks': {'targetGroups': [{'arn': 'tg_arn_untagged', 'port': 80}]}}
+
+        def get(url, **kwargs):
+            mock_response = MagicMock()
+            mock_response.content = orjson.dumps(nodes if url.endswith('/nodes') else config)
+            return mock_response
+        mock_get.side_effect = get
+
+        mock_elb_client = MagicMock()
+        mock_elb.return_value = mock_elb_client
+        mock_elb_client.describe_target_groups.return_value = {'TargetGroups': [
+            {'TargetGroupArn': 'tg_arn_tagged'}, {'TargetGroupArn': 'tg_arn_untagged'}
+        ]}
+        mock_elb_client.describe_tags.return_value = {'TagDescriptions': [
+            {'ResourceArn': 'tg_arn_tagged', 'Tags': [{'Key': 'castai:cluster-id', 'Value': 'test_cluster_id'}]},
+            {'ResourceArn': 'tg_arn_untagged', 'Tags': []}
+        ]}
+
+        def describe_target_health(TargetGroupArn, Targets=None):
+            if TargetGroupArn == 'tg_arn_untagged':
+                return {'TargetHealthDescriptions': [{'Target': {'Id': 'instance_a'}, 'TargetHealth': {'State': 'healthy'}}]}
+            return {'TargetHealthDescriptions': []}
+        mock_elb_client.describe_target_health.side_effect = describe_target_health
+
+        with patch.dict(src.main._TAGGED_TG_CACHE, clear=True), patch('src.main.logger', self.logger, create=True):
+            main()
+
+        scanned = {c.kwargs['TargetGroupArn'] for c in mock_elb_client.describe_target_health.call_args_list}
+        self.assertEqual(scanned, {'tg_arn_tagged', 'tg_arn_untagged'})
+        mock_elb_client.register_targets.assert_not_called()
+        mock_elb_client.deregister_targets.assert_not_called()
+
+    @patch.dict('os.environ', {'API_KEY': 'test_api_key', 'CLUSTER_ID': 'test_cluster_id', 'AWS_REGION': 'us-west-1'})
+    @patch('src.main._elb')
+    @patch('src.main.SESSION.get')
+    def test_main_shares_config_lookup_and_batches_writes(self, mock_get, mock_elb):
+        """
+        Test Case: Full Run with Two Nodes on One Node Configuration
+        This test checks that a run fetches the shared node configuration once, describes each
+        target group's health once for all nodes, and registers both instances in a single call.
+        """
+        labels = {'provisioner.cast.ai/managed-by': 'cast.ai', 'provisioner.cast.ai/node-configuration-id': 'cfg1'}
+        nodes = {'items': [
+            {'id': 'node1', 'instanceId': 'instance_a', 'name': 'node1', 'state': {'phase': 'ready'}, 'labels': labels},
+            {'id': 'node2', 'instanceId': 'instance_b', 'name': 'node2', 'state': {'phase': 'ready'}, 'labels': labels}
+        ]}
+        config = {'eks': {'targetGroups': [{'arn': 'tg_arn_1', 'port': 80}]}}
+
+        def get(url, **kwargs):
+            mock_response = MagicMock()
+            mock_response.content = orjson.dumps(nodes if url.endswith('/nodes') else config)
+            return mock_response
+        mock_get.side_effect = get
+
+        mock_elb_client = MagicMock()
+        mock_elb.return_value = mock_elb_client
+        mock_elb_client.describe_target_groups.return_value = {'TargetGroups': [
+            {'TargetGroupArn': 'tg_arn_1'}, {'TargetGroupArn': 'tg_arn_2'}
+        ]}
+        mock_elb_client.describe_target_health.return_value = {'TargetHealthDescriptions': []}
+
+        with patch('src.main.logger', self.logger, create=True):
+            main()
+
+        config_urls = [c.args[0] for c in mock_get.call_args_list if '/node-configurations/' in c.args[0]]
+        self.assertEqual(len(config_urls), 1)
+        scanned = sorted(c.kwargs['TargetGroupArn'] for c in mock_elb_client.describe_target_health.call_args_list)
+        self.assertEqual(scanned, ['tg_arn_1', 'tg_arn_2'])
+        mock_elb_client.register_targets.assert_called_once_with(
+            TargetGroupArn='tg_arn_1', Targets=[{'Id': 'instance_a'}, {'Id': 'instance_b'}]
+        )
+        mock_elb_client.deregister_targets.assert_not_called()
+
+    def test_discovery_keeps_registrations_found_before_requery_error(self):
+        """
+        Test Case: Error While Probing Instances of a Rejected Target Group
+        This test checks that when probing one instance fails for another reason than
+        InvalidTarget, the error is reported and the registrations of the other instances are kept.
+        """
+        mock_elb_client = MagicMock()
+        mock_elb_client.describe_target_groups.return_value = {'TargetGroups': [
+            {'TargetGroupArn': 'tg_arn_1', 'TargetType': 'instance', 'VpcId': 'vpc-1'}
+        ]}
+        invalid_target = ClientError({'Error': {'Code': 'InvalidTarget', 'Message': 'invalid'}}, 'DescribeTargetHealth')
+        throttled = ClientError({'Error': {'Code': 'Throttling', 'Message': 'slow down'}}, 'DescribeTargetHealth')
+
+        def describe_target_health(TargetGroupArn, Targets):
+            ids = [target['Id'] for target in Targets]
+            if 'instance_gone' in ids:
+                raise invalid_target
+            if ids == ['instance_b']:
+                raise throttled
+            return {'TargetHealthDescriptions': [
+                {'Target': {'Id': iid}, 'TargetHealth': {'State': 'healthy'}} for iid in ids if iid in ('instance_a', 'instance_c')
+            ]}
+        mock_elb_client.describe_target_health.side_effect = describe_target_health
+
+        registry, errors = build_registration_index(mock_elb_client, ['instance_a', 'instance_b', 'instance_c', 'instance_gone'])
+
+        self.assertEqual(dict(registry), {'instance_a': {'tg_arn_1'}, 'instance_c': {'tg_arn_1'}})
+        self.assertEqual(errors, [('tg_arn_1', throttled)])
+
+    def test_discovery_finds_invalid_instance_once(self):
+        """
+        Test Case: One Invalid Instance Across Many Target Groups
+        This test checks that one invalid instance among many nodes is found with a single probe
+        per instance and each rejected target group is re-queried once, rather than once per
+        instance, and that groups in another VPC are not re-queried.
+        """
+        instance_ids = ['instance_gone'] + ['instance_%d' % i for i in range(99)]
+        our_groups = [{'TargetGroupArn': 'tg_arn_%d' % i, 'TargetType': 'instance', 'VpcId': 'vpc-1'} for i in range(50)]
+        other_groups = [{'TargetGroupArn': 'tg_other_%d' % i, 'TargetType': 'instance', 'VpcId': 'vpc-2'} for i in range(5)]
+        mock_elb_client = MagicMock()
+        mock_elb_client.describe_target_groups.return_value = {'TargetGroups': other_groups + our_groups}
+        invalid_target = ClientError({'Error': {'Code': 'InvalidTarget', 'Message': 'invalid'}}, 'DescribeTargetHealth')
+
+        def describe_target_health(TargetGroupArn, Targets):
+            ids = [target['Id'] for target in Targets]
+            if TargetGroupArn.startswith('tg_other_') or 'instance_gone' in ids:
+                raise invalid_target
+            return {'TargetHealthDescriptions': [
+                {'Target': {'Id': iid}, 'TargetHealth': {'State': 'healthy'}} for iid in ids if TargetGroupArn == 'tg_arn_7'
+            ]}
+        mock_elb_client.describe_target_health.side_effect = describe_target_health
+
+        registry, errors = build_registration_index(mock_elb_client, instance_ids)
+
+        self.assertEqual(dict(registry), {iid: {'tg_arn_7'} for iid in instance_ids[1:]})
+        self.assertEqual(errors, [])
+        # 55 batched queries, 102 probes (both VPCs are tried until instance_0 is accepted) and 50 re-queries
+        self.assertEqual(mock_elb_client.describe_target_health.call_count, 55 + 102 + 50)
+        queried = [c.kwargs['TargetGroupArn'] for c in mock_elb_client.describe_target_health.call_args_list]
+        self.assertEqual(queried.count('tg_other_1'), 1)
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file